@@ -31,6 +31,9 @@ setup_logging()
 
 log = logging.getLogger(__name__)
 
+# Waveform memory of the M3202A, in samples
+AWG_MEMORY_SAMPLES = 2**30
+
 @dataclass
 class LoDescriptor:
     channel : int
@@ -61,6 +64,7 @@ class HviModule:
     constants : [HviConstant]
     slot : int
     handle : int = 0
+    chassis : int = 1
     
 @dataclass
 class Hvi:
@@ -92,6 +96,9 @@ class PulseDescriptor:
     id : int
     pri : float()
     pulses : [SubPulseDescriptor] = field(default_factory=list)
+    # CW waveforms may be built as a pure tone segment, played repeatedly,
+    # in place of the filtered full PRI. See QuadLO.coherentSegment
+    coherent : bool = False
 
 @dataclass
 class ModuleDescriptor:
@@ -107,6 +114,7 @@ class AwgDescriptor(ModuleDescriptor):
     pulseDescriptors : [PulseDescriptor]
     queues: [Queue] = field(default_factory=list)
     handle : int = 0
+    chassis : int = 1
     
 @dataclass
 class DaqDescriptor:
@@ -115,11 +123,15 @@ class DaqDescriptor:
     captureCount : int
     trigger : bool
     triggerDelay : int = 0
+    average : bool = False
+    minMax : bool = False
+    keepRaw : bool = False
 
 @dataclass
 class DigDescriptor(ModuleDescriptor):
     daqs : [DaqDescriptor]
     handle : int = 0
+    chassis : int = 1
     
 @dataclass
 class Config:
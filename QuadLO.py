@@ -7,17 +7,24 @@ Created on Fri Nov  6 16:45:52 2020
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 sys.path.append(r'C:\Program Files (x86)\Keysight\SD1\Libraries\Python')
 import keysightSD1 as key
 
 import pulses as pulseLab
+import plotting
+from averaging import CaptureStatistics
 
 import Configuration
+import sd1
+from gains import MAX_CHANNEL_AMPLITUDE, hardwareGains, waveAliases
+import preflight
+from orchestrator import Orchestrator
 
 log = logging.getLogger(__name__)
 
@@ -25,233 +32,505 @@ if len(sys.argv) > 1:
     configName = sys.argv[1]
 else:
     configName = 'latest'   
-log.info("Opening Config file: {})".format(configName))
+log.info("Opening Config file: %s", configName)
 
 config = Configuration.loadConfig(configName)
 
 def main():
-    configureModules()
-    configureHvi()
-    writeHviConstants()
-    compileDownloadHvi()
-    startHvi()
-    time.sleep(1)
-    digData = []
-    for module in config.modules:
-        if module.model == 'M3102A':
-            digData.append(getDigData(module))
-    closeHvi()
-    closeModules()
-    for daqData in digData:
-        for channels in daqData:
-            for wave in channels:
-                plt.plot(wave)
+    try:
+        bringUp()
+        startHvi()
+        time.sleep(1)
+        digData = acquireAll()
+        closeHvi()
+        closeModules()
+    except Exception:
+        # Post-mortem: the SD1 calls leading up to the failure
+        sd1.dumpEvents(logging.ERROR)
+        raise
+    plotting.plotCaptures(digData)
    
-def configureModules():    
-    chassis = key.SD_Module.getChassisByIndex(1)
-    if chassis < 0:
-        log.error("Finding Chassis: {} {}".format(chassis, 
-                                                  key.SD_Error.getErrorMessage(chassis)))
-    log.info("Chassis found: {}".format(chassis))
+def discoverChassis():
+    chassisList = set()
+    for index in range(key.SD_Module.moduleCount()):
+        chassis = sd1.check(key.SD_Module.getChassisByIndex(index), 'getChassisByIndex', index)
+        if chassis >= 0:
+            chassisList.add(chassis)
+    log.info("Chassis found: %s", sorted(chassisList))
+    for chassis in modulesByChassis():
+        if chassis not in chassisList:
+            log.error("Chassis %s is in the configuration but was not found", chassis)
+    return sorted(chassisList)
+
+def modulesByChassis():
+    chassisModules = {}
+    for module in config.modules:
+        chassisModules.setdefault(module.chassis, []).append(module)
+    return chassisModules
+
+def forEachChassis(function):
+    # Runs function(chassis, modules) with one worker per chassis, so the time
+    # taken is that of the slowest chassis rather than the sum of them all.
+    chassisModules = modulesByChassis()
+    with ThreadPoolExecutor(max_workers=len(chassisModules)) as executor:
+        futures = {chassis: executor.submit(function, chassis, modules)
+                   for chassis, modules in chassisModules.items()}
+        return {chassis: future.result() for chassis, future in futures.items()}
+
+def bringUp():
+    # Everything up to starting the HVI, as a dependency graph so that
+    # waveform synthesis, the HVI file open, FPGA loads and register writes
+    # overlap wherever they do not depend on each other.
+    preflight.preflight(config)
+    graph = Orchestrator()
+    found = graph.add('discover chassis', discoverChassis)
+    hviOpen = graph.add('open HVI', openHvi)
+    ready = []
     for module in config.modules:
+        name = '{} chassis {} slot {}'.format(module.model, module.chassis, module.slot)
         if module.model == 'M3202A':
-            configureAwg(chassis, module)
+            normalized = hardwareGains(module.pulseDescriptors, module.queues)[1]
+            synth = graph.add('synthesize ' + name,
+                              partial(synthesizeWaves,
+                                      module.sample_rate,
+                                      module.pulseDescriptors,
+                                      normalized))
+            opened = graph.add('open ' + name,
+                               partial(openAwg, module.chassis, module),
+                               [found])
+            fpga = graph.add('FPGA load ' + name, partial(loadFpga, module), [opened])
+            prepared = graph.add('registers ' + name, partial(prepareAwg, module), [fpga])
+            def upload(module=module, synth=synth, normalized=normalized):
+                uploadWaves(module, graph.tasks[synth].result, normalized)
+            uploaded = graph.add('upload ' + name, upload, [synth, prepared])
+            ready.append(graph.add('queue ' + name, partial(startAwg, module), [uploaded]))
         elif module.model == 'M3102A':
-            configureDig(chassis, module)                
+            opened = graph.add('open ' + name,
+                               partial(openDig, module.chassis, module),
+                               [found])
+            fpga = graph.add('FPGA load ' + name, partial(loadFpga, module), [opened])
+            ready.append(graph.add('DAQ config ' + name, partial(configureDaqs, module), [fpga]))
+    assigned = graph.add('assign HVI', assignHvi, [hviOpen] + ready)
+    constants = graph.add('HVI constants', writeHviConstants, [assigned])
+    graph.add('compile HVI', compileDownloadHvi, [constants])
+    graph.run()
 
-def configureAwg(chassis, module):
-    log.info("Configuring AWG in slot {}...".format(module.slot))
+def openAwg(chassis, module):
+    log.info("Configuring AWG in slot %s...", module.slot)
     module.handle = key.SD_AOU()
     awg = module.handle
-    error = awg.openWithSlotCompatibility('', 
-                                          chassis, 
-                                          module.slot,
-                                          key.SD_Compatibility.KEYSIGHT)
-    if error < 0:
-        log.info("Error Opening - {}".format(error))
-    log.info("Loading FPGA image: {}".format(module.fpga.file_name))
-    error = awg.FPGAload(os.getcwd() + '\\' + module.fpga.file_name)
-    if error < 0:
-       log.error('Loading FPGA bitfile: {} {}'.format(error, 
-                                                      key.SD_Error.getErrorMessage(error)))
+    sd1.check(awg.openWithSlotCompatibility('', 
+                                            chassis, 
+                                            module.slot,
+                                            key.SD_Compatibility.KEYSIGHT),
+              'openWithSlotCompatibility', chassis, module.slot)
+
+def loadFpga(module):
+    if module.fpga.file_name != "":
+        log.info("Loading FPGA image: %s", module.fpga.file_name)
+        sd1.check(module.handle.FPGAload(os.getcwd() + '\\' + module.fpga.file_name),
+                  'FPGAload', module.slot, module.fpga.file_name)
+
+def prepareAwg(module):
+    awg = module.handle
     #Clear all queues and waveforms
-    awg.waveformFlush()
+    sd1.check(awg.waveformFlush(), 'waveformFlush', module.slot)
     for channel in range(module.channels):
-        awg.AWGflush(channel + 1)
+        sd1.check(awg.AWGflush(channel + 1), 'AWGflush', module.slot, channel + 1)
     #Set up the channels suppporting interleaving
     setupLOs(module)
-    for register in module.fpga.registers:
-        error = module.handle.FPGAwritePCport(0, 
-                                              [register.value], 
-                                              register.address, 
-                                              key.SD_AddressingMode.FIXED,
-                                              key.SD_AccessMode.NONDMA)
-        if error < 0:
-            log.error('WriteRegister: {} {}'.format(error, 
-                                                    key.SD_Error.getErrorMessage(error)))
-            log.error('Address: {}'.format(8))
-            log.error('Buffer [{}]'.format(module.mode))
-    loadWaves(module)
+    writeRegisters(module)
+
+def startAwg(module):
+    awg = module.handle
     enqueueWaves(module)
     trigmask = 0
     for channel in range(module.channels):
-        awg.channelWaveShape(channel + 1, key.SD_Waveshapes.AOU_AWG)
+        sd1.check(awg.channelWaveShape(channel + 1, key.SD_Waveshapes.AOU_AWG),
+                  'channelWaveShape', module.slot, channel + 1)
         trigmask = trigmask | 2**channel
     #Remove this if using HVI
 #            log.info("triggering with {}".format(trigmask))
 #            awg.AWGtriggerMultiple(trigmask)
 
+def writeRegisters(module):
+    for register in module.fpga.registers:
+        sd1.check(module.handle.FPGAwritePCport(0, 
+                                                [register.value], 
+                                                register.address, 
+                                                key.SD_AddressingMode.FIXED,
+                                                key.SD_AccessMode.NONDMA),
+                  'FPGAwritePCport', module.slot, register.address, register.value)
+
 def closeModules():
-    for module in config.modules:
+    forEachChassis(closeChassis)
+    log.info("Finished stopping and closing Modules")
+
+def closeChassis(chassis, modules):
+    for module in modules:
         if module.model == "M3202A":
             stopAwg(module)
         elif module.model == "M3102A":
             stopDig(module)
-        module.handle.close()
-    log.info("Finished stopping and closing Modules")
+        sd1.check(module.handle.close(), 'close', module.slot)
 
 def stopAwg(module):
-    log.info("Stopping AWG in slot {}...".format(module.slot))
+    log.info("Stopping AWG in slot %s...", module.slot)
     for channel in range(1, module.channels + 1):
-        error = module.handle.AWGstop(channel)
-        if error < 0:
-            log.info("Stopping AWG failed! - {}".format(error))
+        sd1.check(module.handle.AWGstop(channel), 'AWGstop', module.slot, channel)
     
 def stopDig(module):
-    log.info("Stopping Digitizer in slot {}...".format(module.slot))
+    log.info("Stopping Digitizer in slot %s...", module.slot)
     for channel in range(1, module.channels + 1):
-        error = module.handle.DAQstop(channel)
-        if error < 0:
-            log.info("Stopping Digitizer failed! - {}".format(error))
+        sd1.check(module.handle.DAQstop(channel), 'DAQstop', module.slot, channel)
     
 
 def setupLOs(module):
     for loBank in module.loDescriptors:
         for ii, carrier in enumerate(loBank.frequencies):
-            log.info("Setting LO: {} to {} on channel {}".format(ii, 
-                                                                 carrier, 
-                                                                 loBank.channel))
+            log.info("Setting LO: %s to %s on channel %s", ii, carrier, loBank.channel)
             [A, B] = calcAandB(carrier, module.sample_rate)
-            error = module.handle.FPGAwritePCport(loBank.channel - 1, 
-                                                  [A], 
-                                                  ii * 2, 
-                                                  key.SD_AddressingMode.FIXED, 
-                                                  key.SD_AccessMode.NONDMA)
-            if error < 0:
-                log.error('WriteRegister: {} {}'.format(error, 
-                                                        key.SD_Error.getErrorMessage(error)))
-                log.error('Address: {}'.format(ii))
-                log.error('Buffer [{}]'.format(A))
-            error = module.handle.FPGAwritePCport(loBank.channel, 
-                                                  [B], 
-                                                  ii * 2 + 1, 
-                                                  key.SD_AddressingMode.FIXED,
-                                                  key.SD_AccessMode.NONDMA)
-            if error < 0:
-                log.error('WriteRegister: {} {}'.format(error, 
-                                                        key.SD_Error.getErrorMessage(error)))
-                log.error('Address: {}'.format(ii + 1))
-                log.error('Buffer [{}]'.format(B))
+            sd1.check(module.handle.FPGAwritePCport(loBank.channel - 1, 
+                                                    [A], 
+                                                    ii * 2, 
+                                                    key.SD_AddressingMode.FIXED, 
+                                                    key.SD_AccessMode.NONDMA),
+                      'FPGAwritePCport', module.slot, ii * 2, A)
+            sd1.check(module.handle.FPGAwritePCport(loBank.channel, 
+                                                    [B], 
+                                                    ii * 2 + 1, 
+                                                    key.SD_AddressingMode.FIXED,
+                                                    key.SD_AccessMode.NONDMA),
+                      'FPGAwritePCport', module.slot, ii * 2 + 1, B)
             
-def loadWaves(module):
-    for pulseDescriptor in module.pulseDescriptors:
+# Digitizer input full scale, in V, as set by configureDaqs
+DIG_FULL_SCALE = 2.0
+# Digitizer samples are 16 bit, spanning plus and minus full scale
+DIG_VOLTS_PER_COUNT = DIG_FULL_SCALE / 2**15
+
+def coherentSegment(sampleRate, pulseDescriptor, amplitude):
+    # A single-pulse waveform that is on for its whole PRI is CW. If it is
+    # marked coherent, and its carrier repeats phase continuously within a
+    # whole number of start delay units that exactly divides the PRI, it is
+    # built as that one short segment, played repeatedly, rather than as the
+    # full PRI. The segment is a pure tone, without the filtered edges the
+    # full synthesis has at each PRI boundary, hence opt in only.
+    # Returns (wave, repeats), or None to synthesize the full PRI.
+    pulse = pulseDescriptor.pulses[0]
+    if not pulseDescriptor.coherent:
+        return None
+    if pulse.carrier == 0 or pulse.toa != 0 or pulse.width < pulseDescriptor.pri:
+        return None
+    granularity = int(np.round(sampleRate * START_DELAY_UNIT))
+    samples = int(np.round(pulseDescriptor.pri * sampleRate))
+    segment = pulseLab.createCoherentTone(sampleRate,
+                                          [pulse.carrier],
+                                          [amplitude],
+                                          pulseDescriptor.pri,
+                                          granularity)
+    if segment is None:
+        return None
+    tone, repeats = segment
+    if repeats == 1 or len(tone.wave) * repeats != samples:
+        return None
+    return tone.wave, repeats
+
+def synthesizeWaves(sampleRate, pulseDescriptors, normalized=()):
+    # Pure computation, no SD1 calls, so it can safely run in a worker thread
+    # while the hardware is busy with something else. Waveforms in normalized
+    # are synthesized at full scale, see hardwareGains.
+    # Returns a list of (waveform ID, samples, repeats), where repeats is the
+    # number of times the samples are played to make up one PRI.
+    waves = []
+    aliases = waveAliases(pulseDescriptors)
+    for pulseDescriptor in pulseDescriptors:
+        if aliases[pulseDescriptor.id] != pulseDescriptor.id:
+            # Same content as an earlier waveform, which the queue will use
+            continue
         if len(pulseDescriptor.pulses) > 1:
-            waves = []
-            for pulse in pulseDescriptor.pulses:
-                samples = pulseLab.createPulse(module.sample_rate / 5,
-                                            pulse.width,
-                                            pulse.bandwidth,
-                                            pulse.amplitude / 1.5,
-                                            pulseDescriptor.pri,
-                                            pulse.toa)
-                if pulse.carrier != 0:
-                    carrier = pulseLab.createTone(module.sample_rate, 
-                                                  pulse.carrier,
-                                                  0,
-                                                  samples.timebase)
-                    wave = samples.wave * carrier
-                waves.append(samples.wave)
-            wave = interweavePulses(waves)
+            wave = composeInterleaved(sampleRate, pulseDescriptor)
         else:
             #not interleaved, so normal channel
             pulse = pulseDescriptor.pulses[0]
-            samples = pulseLab.createPulse(module.sample_rate,
+            if pulseDescriptor.id in normalized:
+                amplitude = 1.0
+            else:
+                amplitude = pulse.amplitude / MAX_CHANNEL_AMPLITUDE
+            segment = coherentSegment(sampleRate, pulseDescriptor, amplitude)
+            if segment is not None:
+                wave, repeats = segment
+                log.info("Waveform ID %s is CW: %s samples x %s repeats",
+                         pulseDescriptor.id, len(wave), repeats)
+                waves.append((pulseDescriptor.id, wave, repeats))
+                continue
+            samples = pulseLab.createPulse(sampleRate,
                                         pulse.width,
                                         pulse.bandwidth,
-                                        pulse.amplitude / 1.5,
+                                        amplitude,
                                         pulseDescriptor.pri,
                                         pulse.toa)
             wave = samples.wave
             if pulse.carrier != 0:
-                carrier = pulseLab.createTone(module.sample_rate, 
-                                              pulse.carrier,
-                                              0,
-                                              samples.timebase)
-                wave = wave * carrier
+                pulseLab.applyTone(sampleRate, pulse.carrier, 0, wave)
+        waves.append((pulseDescriptor.id, wave, 1))
+    return waves
+
+# Start delays are expressed in 10ns units
+START_DELAY_UNIT = 10E-09
+# Samples below this are lost in the AWG's 16 bit quantization
+ZERO_THRESHOLD = 1 / 2**15
+
+def trimConstraints(module, aliases):
+    # Waveforms that cannot lose their leading and trailing dead time
+    # (repeated back to back with no start delay between them), and those that
+    # can only lose their leading dead time (followed, by wrapping round a
+    # cyclic queue, by an auto-triggered waveform whose start delay would also
+    # apply on the first pass).
+    noTrim = set()
+    noTrail = set()
+    for queue in module.queues:
+        entries = compressQueue(queue.items, aliases)
+        for ii, entry in enumerate(entries):
+            if entry[3] != 1:
+                noTrim.add(entry[0])
+            if ii == len(entries) - 1 and queue.cyclic and not entries[0][1]:
+                noTrail.add(entry[0])
+    return noTrim, noTrail
+
+def planWaves(module, waves):
+    # Trims the dead time from the start and end of each waveform. Trimmed
+    # leading samples are added back as start delay when enqueueing, and
+    # trailing samples as start delay on an auto-triggered successor (they
+    # are not needed before a triggered one). Repeated CW segments are never
+    # trimmed, as they have no dead time and play back to back.
+    # Returns ([(waveform ID, samples)], {waveform ID: trims}, {waveform ID: repeats}).
+    granularity = int(np.round(module.sample_rate * START_DELAY_UNIT))
+    noTrim, noTrail = trimConstraints(module, waveAliases(module.pulseDescriptors))
+    trims = {}
+    repeated = {}
+    planned = []
+    before = 0
+    after = 0
+    for waveId, wave, repeats in waves:
+        start, stop = 0, len(wave)
+        if repeats != 1:
+            repeated[waveId] = repeats
+        elif waveId not in noTrim:
+            start, stop = pulseLab.trimZeros(wave, granularity, ZERO_THRESHOLD)
+            if waveId in noTrail:
+                stop = len(wave)
+        trims[waveId] = (start // granularity, (len(wave) - stop) // granularity)
+        planned.append((waveId, wave[start:stop]))
+        before += len(wave) * repeats
+        after += stop - start
+    log.info("Slot %s: waveform memory %s -> %s samples (%.3f%% -> %.3f%% of %s)",
+             module.slot,
+             before,
+             after,
+             100 * before / Configuration.AWG_MEMORY_SAMPLES,
+             100 * after / Configuration.AWG_MEMORY_SAMPLES,
+             Configuration.AWG_MEMORY_SAMPLES)
+    return planned, trims, repeated
+
+def uploadWaves(module, waves, normalized):
+    # normalized: the waveform IDs synthesized at full scale, kept so that
+    # later amplitude changes know which waveforms on the AWG can take their
+    # amplitude from the channel amplitude alone.
+    module.normalizedWaves = set(normalized)
+    waves, module.waveTrims, module.waveRepeats = planWaves(module, waves)
+    for waveId, wave in waves:
         waveform = key.SD_Wave()
-        error = waveform.newFromArrayDouble(key.SD_WaveformTypes.WAVE_ANALOG, 
-                                            wave)
-        if error < 0:
-            log.info("Error Creating Wave: {} {}".format(error,
-                                                          key.SD_Error.getErrorMessage(error)))
-        log.info("Loading waveform length: {} as ID: {} ".format(len(wave), 
-                                                                 pulseDescriptor.id))
-        error = module.handle.waveformLoad(waveform, pulseDescriptor.id)
-        if error < 0:
-            log.info("Error Loading Wave - {} {}".format(error,
-                                                         key.SD_Error.getErrorMessage(error)))
+        sd1.check(waveform.newFromArrayDouble(key.SD_WaveformTypes.WAVE_ANALOG, 
+                                              wave),
+                  'newFromArrayDouble', waveId)
+        log.info("Loading waveform length: %s as ID: %s", len(wave), waveId)
+        sd1.check(module.handle.waveformLoad(waveform, waveId),
+                  'waveformLoad', module.slot, waveId)
                     
+def compressQueue(items, aliases):
+    # Folds runs of identical consecutive queue items into a single entry with
+    # a repeat count. Returns a list of [pulse_id, trigger, start_time, cycles,
+    # cycleTrigger] where cycleTrigger means every cycle waits for its own
+    # trigger, as each of the original items did.
+    # Only items without a start delay are folded, as the delay is applied
+    # once per entry, not per cycle. Triggered items are only folded when each
+    # plays once per trigger.
+    entries = []
+    for item in items:
+        pulseId = aliases.get(item.pulse_id, item.pulse_id)
+        if entries:
+            last = entries[-1]
+            foldable = (last[0] == pulseId
+                        and last[1] == item.trigger
+                        and last[2] == 0 and item.start_time == 0
+                        and last[3] > 0 and item.cycles > 0)
+            if foldable and item.trigger:
+                foldable = (last[4] or last[3] == 1) and item.cycles == 1
+            if foldable:
+                last[3] += item.cycles
+                last[4] = item.trigger
+                continue
+        entries.append([pulseId, item.trigger, item.start_time, item.cycles, False])
+    return entries
+
+def channelGain(module, channel, gains):
+    # Channel amplitude for the channel, including any calibration correction
+    gain = gains.get(channel, MAX_CHANNEL_AMPLITUDE)
+    gain *= getattr(module, 'gainCorrections', {}).get(channel, 1.0)
+    return min(gain, MAX_CHANNEL_AMPLITUDE)
+
+def applyGains(module):
+    gains, normalized = hardwareGains(module.pulseDescriptors, module.queues)
+    for queue in module.queues:
+        gain = channelGain(module, queue.channel, gains)
+        log.info("Setting channel %s amplitude to %s", queue.channel, gain)
+        sd1.check(module.handle.channelAmplitude(queue.channel, gain),
+                  'channelAmplitude', module.slot, queue.channel)
+
+def setAmplitude(module, pulseId, amplitude):
+    # Changes a single-pulse waveform's amplitude through the channel
+    # amplitude, without resynthesizing or reloading it. Returns False, with
+    # nothing changed, if the waveform has its amplitude baked in on the AWG
+    # (or the new amplitude would change which waveforms need it baked in).
+    loaded = getattr(module, 'normalizedWaves', set())
+    if waveAliases(module.pulseDescriptors)[pulseId] not in loaded:
+        return False
+    pulse = [pulseDescriptor for pulseDescriptor in module.pulseDescriptors
+             if pulseDescriptor.id == pulseId][0].pulses[0]
+    previous = pulse.amplitude
+    pulse.amplitude = amplitude
+    gains, normalized = hardwareGains(module.pulseDescriptors, module.queues)
+    if normalized != loaded:
+        pulse.amplitude = previous
+        return False
+    applyGains(module)
+    return True
+
+def rearmDaqs(module):
+    for daq in module.daqs:
+        sd1.check(module.handle.DAQstart(daq.channel), 'DAQstart', module.slot, daq.channel)
+
+def measureAmplitude(digModule, daq):
+    # Runs the HVI once and returns the peak of the average of the captures
+    # on the given acquisition, in V.
+    startHvi()
+    daqData = getDigData(digModule)
+    sd1.check(config.hvi.handle.stop(), 'HVI stop')
+    rearmDaqs(digModule)
+    captures = daqData[digModule.daqs.index(daq)]
+    if isinstance(captures, CaptureStatistics):
+        mean = captures.mean
+    else:
+        mean = np.mean(np.array(captures, dtype=float), axis=0)
+    return np.max(np.abs(mean))
+
+def calibrateGain(module, channel, digModule, daq, target, iterations=5, tolerance=0.01):
+    # Closed loop correction of a channel's amplitude, with the channel wired
+    # to the digitizer acquisition daq. Adjusts only the channel amplitude,
+    # so no waveforms are reloaded. Returns the final measured amplitude.
+    # Only channels with their amplitude applied by the channel amplitude can
+    # be calibrated, as the rest already run at the maximum and could never
+    # be corrected upwards.
+    gains, normalized = hardwareGains(module.pulseDescriptors, module.queues)
+    if channel not in gains:
+        raise ValueError("Slot {} channel {} has its amplitude baked into its "
+                         "waveforms, so cannot be calibrated".format(module.slot, channel))
+    corrections = getattr(module, 'gainCorrections', {})
+    module.gainCorrections = corrections
+    measured = 0.0
+    for ii in range(iterations):
+        measured = measureAmplitude(digModule, daq)
+        log.info("Calibrating slot %s channel %s: measured %s V, target %s V",
+                 module.slot, channel, measured, target)
+        if measured <= 0 or abs(measured - target) <= tolerance * target:
+            break
+        correction = corrections.get(channel, 1.0) * target / measured
+        if gains[channel] * correction > MAX_CHANNEL_AMPLITUDE:
+            log.error("Calibrating slot %s channel %s: needs a channel amplitude of "
+                      "%s V, more than the maximum %s V",
+                      module.slot, channel, gains[channel] * correction,
+                      MAX_CHANNEL_AMPLITUDE)
+            break
+        corrections[channel] = correction
+        applyGains(module)
+    return measured
+
 def enqueueWaves(module):
+    gains, normalized = hardwareGains(module.pulseDescriptors, module.queues)
+    aliases = waveAliases(module.pulseDescriptors)
     for queue in module.queues:
-        for item in queue.items:
-            if item.trigger:
+        entries = compressQueue(queue.items, aliases)
+        log.info("Channel %s: %s queue items compressed to %s entries",
+                 queue.channel,
+                 len(queue.items),
+                 len(entries))
+        trims = getattr(module, 'waveTrims', {})
+        repeated = getattr(module, 'waveRepeats', {})
+        carry = 0
+        for pulseId, triggered, start_time, cycles, cycleTrigger in entries:
+            lead, trail = trims.get(pulseId, (0, 0))
+            # A CW segment plays repeats times for each PRI. Zero cycles, for
+            # ever, stays as it is.
+            repeats = repeated.get(pulseId, 1)
+            entryCount = 1
+            if repeats != 1 and cycles > 0:
+                if cycleTrigger:
+                    # Every PRI waits for its own trigger, which a cycle
+                    # count cannot express, so each becomes its own entry.
+                    entryCount, cycles, cycleTrigger = cycles, repeats, False
+                else:
+                    cycles *= repeats
+            if cycleTrigger:
+                trigger = key.SD_TriggerModes.SWHVITRIG_CYCLE
+            elif triggered:
                 trigger = key.SD_TriggerModes.SWHVITRIG
             else:
                 trigger = key.SD_TriggerModes.AUTOTRIG
-            start_delay = item.start_time / 10E-09 # expressed in 10ns
-            start_delay = int(np.round(start_delay))
-            log.info("Enqueueing: {} in channel {}".format(item.pulse_id, 
-                                                           queue.channel))
-            error = module.handle.AWGqueueWaveform(queue.channel, 
-                                                    item.pulse_id, 
-                                                    trigger, 
-                                                    start_delay, 
-                                                    1, 
-                                                    0)
-            if error < 0:
-                log.info("Queueing waveform failed! - {}".format(error))
-        log.info("Setting queue 'Cyclic' to {}".format(queue.cyclic))
+            start_delay = start_time / START_DELAY_UNIT # expressed in 10ns
+            start_delay = int(np.round(start_delay)) + lead
+            if not triggered:
+                start_delay += carry
+            carry = trail
+            log.info("Enqueueing: %s x%s in channel %s", pulseId, cycles, queue.channel)
+            for entry in range(entryCount):
+                sd1.check(module.handle.AWGqueueWaveform(queue.channel, 
+                                                         pulseId, 
+                                                         trigger, 
+                                                         start_delay, 
+                                                         cycles, 
+                                                         0),
+                          'AWGqueueWaveform', module.slot, queue.channel, pulseId)
+        log.info("Setting queue 'Cyclic' to %s", queue.cyclic)
         if queue.cyclic:
             queueMode = key.SD_QueueMode.CYCLIC
         else:
             queueMode = key.SD_QueueMode.ONE_SHOT
-        error =module.handle.AWGqueueConfig(queue.channel, 
-                                            queueMode)
-        if error < 0:
-            log.error("Configure cyclic mode failed! - {}".format(error))
+        sd1.check(module.handle.AWGqueueConfig(queue.channel, 
+                                               queueMode),
+                  'AWGqueueConfig', module.slot, queue.channel)
 
         # This is only required for channels that implement the 'vanilla'
         # ModGain block. (It does no harm to other applications that do not).
         # It assumes that the source is to be directly from the AWG, rather 
         # than function generator.
-        log.info("Setting Output Characteristics for channel {}".format(queue.channel))
-        error = module.handle.channelWaveShape(queue.channel, key.SD_Waveshapes.AOU_AWG)
-        if error < 0:
-            log.warn("Error Setting Waveshape - {}".format(error))
-        error = module.handle.channelAmplitude(queue.channel, 1.5)
-        if error < 0:
-            log.warn("Error Setting Amplitude - {}".format(error))
-        module.handle.AWGstart(queue.channel)
+        log.info("Setting Output Characteristics for channel %s", queue.channel)
+        sd1.check(module.handle.channelWaveShape(queue.channel, key.SD_Waveshapes.AOU_AWG),
+                  'channelWaveShape', module.slot, queue.channel, level=logging.WARNING)
+        sd1.check(module.handle.channelAmplitude(queue.channel,
+                                                 channelGain(module, queue.channel, gains)),
+                  'channelAmplitude', module.slot, queue.channel, level=logging.WARNING)
+        sd1.check(module.handle.AWGstart(queue.channel), 'AWGstart', module.slot, queue.channel)
 
 
 def writeHviConstants():
     hvi = config.hvi.handle
     for hviModule in config.hvi.hviModules:
         for constant in hviModule.constants:
-            log.info("Writing HVI Constant: {}, {}{} to {}".format(constant.name,
-                                                                    constant.value,
-                                                                    constant.units,
-                                                                    hviModule.name))
+            log.info("Writing HVI Constant: %s, %s%s to %s",
+                     constant.name,
+                     constant.value,
+                     constant.units,
+                     hviModule.name)
             if constant.units == '':
                 error = hvi.writeIntegerConstantWithUserName(hviModule.name, 
                                                              constant.name, 
@@ -261,110 +540,96 @@ def writeHviConstants():
                                                             constant.name, 
                                                             float(constant.value),
                                                             constant.units)
+            sd1.check(error, 'writeConstantWithUserName', hviModule.name, constant.name)
     
-            if error < 0:
-                log.error(" for {}, Writing HVI Register: {} - Error: {}: {}".format(hviModule.name,
-                                                                                     constant.name, 
-                                                                                     error, 
-                                                                                     key.SD_Error.getErrorMessage(error)))
-    
-def configureHvi():
+def openHvi():
     config.hvi.handle = key.SD_HVI()
     hvi = config.hvi.handle
-    log.info("Opening HVI file: {}".format(config.hvi.file_name))
+    log.info("Opening HVI file: %s", config.hvi.file_name)
     hviID = hvi.open(config.hvi.file_name)
+    # Expected results, so recorded but not counted as errors
     if hviID ==  key.SD_Error.RESOURCE_NOT_READY: #Only for old library
-        log.debug("No Critical Error - {}: {}".format(hviID, key.SD_Error.getErrorMessage(hviID)))
+        sd1.record('HVI open', hviID)
         log.debug("Using old library -> Need to compile HVI...")
     elif hviID == key.SD_Error.DEMO_MODULE: #Only for old library
-         log.debug("No Critical Error - {} {}".format(hviID, key.SD_Error.getErrorMessage(hviID)))
-         log.debug("Using old library -> need to assigning HW modules...")
-    elif hviID < 0:
-         log.error("Opening HVI - {}: {}".format(hviID, key.SD_Error.getErrorMessage(hviID)))
-       
+        sd1.record('HVI open', hviID)
+        log.debug("Using old library -> need to assigning HW modules...")
+    else:
+        sd1.check(hviID, 'HVI open', config.hvi.file_name)
+
+def assignHvi():
+    hvi = config.hvi.handle
+    error = 0
     for hviModule in config.hvi.hviModules:
-        #Find the handle for this module from its slot
+        #Find the handle for this module from its chassis and slot
         for module in config.modules:
-            if module.slot == hviModule.slot:
+            if (module.chassis, module.slot) == (hviModule.chassis, hviModule.slot):
                 hviModule.handle = module.handle
-                log.info("Assigning {} to {} in slot {}".format(hviModule.name, module.model, module.slot))
+                log.info("Assigning %s to %s in chassis %s slot %s",
+                         hviModule.name,
+                         module.model,
+                         module.chassis,
+                         module.slot)
                 error = hvi.assignHardwareWithUserNameAndModuleID(hviModule.name, module.handle)
                 if error == -8069:
-                    log.debug("Assigning HVI {}, Spurious Error- {}: {}".format(hviModule.name, error, key.SD_Error.getErrorMessage(error)))
-                    log.info("HVI HW assigned for {}, {} in slot {}".format(hviModule.name, module.model, module.slot))
-                elif error < 0:
-                    error_msg = "HVI assign HW AOU Failed for: {} in slot {}, {}: {}".format(
-                            hviModule.name, 
-                            module.model,
-                            module.slot,
-                            key.SD_Error.getErrorMessage(error))
-                    log.error(error_msg)
+                    # Spurious, unless it is the last module assigned
+                    sd1.record('assignHardwareWithUserNameAndModuleID', error, hviModule.name)
                 else:
-                    log.info("HVI HW assigned for {}, {} in slot {}".format(hviModule.name, module.model, module.slot))
+                    sd1.check(error, 'assignHardwareWithUserNameAndModuleID',
+                              hviModule.name, module.model, module.slot)
+                if error >= 0 or error == -8069:
+                    log.info("HVI HW assigned for %s, %s in slot %s",
+                             hviModule.name, module.model, module.slot)
     # if the last module assigned has this error then it is more serious
     if error == -8069:
-        log.error("Assigning HVI - {}: {}".format(error, key.SD_Error.getErrorMessage(error)))
+        sd1.check(error, 'assignHardwareWithUserNameAndModuleID', 'last module assigned',
+                  raiseError=False)
 
     
 def compileDownloadHvi():
     log.info("Compiling HVI...")
     cmpID = config.hvi.handle.compile()
     if cmpID != 0:
-        error = "HVI compile failed : {}".format(key.SD_Error.getErrorMessage(cmpID))
-        log.debug(error)
+        log.debug("HVI compile failed : %s", sd1.ErrorMessage(cmpID))
     log.info("Loading HVI...")
     cmpID = config.hvi.handle.load()
     if cmpID == -8038:
         log.debug("HVI contains Demo Module. Please make sure you do an assignHW()")
-    elif cmpID != 0:
-        error = "HVI load failed : {}".format(key.SD_Error.getErrorMessage(cmpID))
-        log.error(error)
+    else:
+        sd1.check(cmpID, 'HVI load')
 
 def startHvi():
     log.info("Starting HVI...")
-    error = config.hvi.handle.start()
-    if (error < 0):
-        log.error("Starting HVI- {}: {}".format(error, key.SD_Error.getErrorMessage(error)))
+    sd1.check(config.hvi.handle.start(), 'HVI start')
         
 def closeHvi():
-    error  = config.hvi.handle.releaseHW()
-    if (error < 0):
-        log.error("Releasing HW - {}: {}".format(error, key.SD_Error.getErrorMessage(error)))
-    error = config.hvi.handle.close()
-    if (error < 0):
-        log.error("Closing HVI - {}: {}".format(error, key.SD_Error.getErrorMessage(error)))
-
-def configureDig(chassis, module):
-    log.info("Configuring DIG in slot {}...".format(module.slot))
+    sd1.check(config.hvi.handle.releaseHW(), 'HVI releaseHW')
+    sd1.check(config.hvi.handle.close(), 'HVI close')
+
+def openDig(chassis, module):
+    log.info("Configuring DIG in slot %s...", module.slot)
     module.handle = key.SD_AIN()
     dig = module.handle
-    error = dig.openWithSlotCompatibility('', 
-                                          chassis, 
-                                          module.slot,
-                                          key.SD_Compatibility.KEYSIGHT)
-    if error < 0:
-        log.info("Error Opening - {}".format(error))
-    if module.fpga.file_name != "":
-        log.info("Loading FPGA image: {}".format(module.fpga.file_name))
-        error = dig.FPGAload(os.getcwd() + '\\' + module.fpga.file_name)
-        if error < 0:
-           log.error('Loading FPGA bitfile: {} {}'.format(error, 
-                                                          key.SD_Error.getErrorMessage(error)))
+    sd1.check(dig.openWithSlotCompatibility('', 
+                                            chassis, 
+                                            module.slot,
+                                            key.SD_Compatibility.KEYSIGHT),
+              'openWithSlotCompatibility', chassis, module.slot)
+
+def configureDaqs(module):
+    dig = module.handle
    #Configure all channels to be DC coupled and 50 Ohm
     for channel in range(1, module.channels + 1):
-     error = dig.DAQflush(channel)
-     if error < 0:
-         log.info("Error Flushing")
-    error = dig.channelInputConfig(
-                                   channel, 
-                                   2.0,
-                                   key.AIN_Impedance.AIN_IMPEDANCE_50,
-                                   key.AIN_Coupling.AIN_COUPLING_DC)
-    if error < 0:
-         log.info("Error Configuring channel")
+     sd1.check(dig.DAQflush(channel), 'DAQflush', module.slot, channel)
+    sd1.check(dig.channelInputConfig(
+                                     channel, 
+                                     DIG_FULL_SCALE,
+                                     key.AIN_Impedance.AIN_IMPEDANCE_50,
+                                     key.AIN_Coupling.AIN_COUPLING_DC),
+              'channelInputConfig', module.slot, channel)
 
     for daq in module.daqs:
-        log.info("Configuring Acquisition parameters for channel {}".format(daq.channel))
+        log.info("Configuring Acquisition parameters for channel %s", daq.channel)
         if daq.trigger:
             trigger_mode = key.SD_TriggerModes.SWHVITRIG
         else:
@@ -372,44 +637,66 @@ def configureDig(chassis, module):
         trigger_delay = daq.triggerDelay * module.sample_rate  # expressed in samples
         trigger_delay = int(np.round(trigger_delay))
         pointsPerCycle = int(np.round(daq.captureTime * module.sample_rate))
-        error = dig.DAQconfig(
-            daq.channel,
-            pointsPerCycle,
-            daq.captureCount,
-            trigger_delay,
-            trigger_mode)
-        if error < 0:
-            log.info("Error Configuring Acquisition")
-        log.info("Starting DAQ, channel {}".format(daq.channel))
-        error = dig.DAQstart(daq.channel)
-        if error < 0:
-            log.info("Error Starting Digitizer")
+        sd1.check(dig.DAQconfig(
+                      daq.channel,
+                      pointsPerCycle,
+                      daq.captureCount,
+                      trigger_delay,
+                      trigger_mode),
+                  'DAQconfig', module.slot, daq.channel)
+        log.info("Starting DAQ, channel %s", daq.channel)
+        sd1.check(dig.DAQstart(daq.channel), 'DAQstart', module.slot, daq.channel)
 
 def getDigDataRaw(module):
     TIMEOUT = 1000
     daqData = []
     for daq in module.daqs:
-        channelData = []
+        pointsPerCycle = int(np.round(daq.captureTime * module.sample_rate))
+        if daq.average:
+            # Captures are folded into running statistics as they are read,
+            # rather than kept.
+            channelData = CaptureStatistics(pointsPerCycle, daq.minMax, daq.keepRaw)
+            store = channelData.add
+        else:
+            channelData = []
+            store = channelData.append
+        read = module.handle.DAQread
+        record = sd1.record
         for capture in range(daq.captureCount):
-            pointsPerCycle = int(np.round(daq.captureTime * module.sample_rate))
-            dataRead = module.handle.DAQread(daq.channel,
-                                             pointsPerCycle,
-                                             TIMEOUT)
+            dataRead = read(daq.channel, pointsPerCycle, TIMEOUT)
+            record('DAQread', len(dataRead))
             if len(dataRead) != pointsPerCycle:
-                log.warning("Slot:{} Attempted to Read {} samples, "
-                            "actually read {} samples".format(module.slot, 
-                                                              pointsPerCycle, 
-                                                              len(dataRead)))
-            channelData.append(dataRead)
+                log.warning("Slot:%s Attempted to Read %s samples, "
+                            "actually read %s samples",
+                            module.slot, 
+                            pointsPerCycle, 
+                            len(dataRead))
+            store(dataRead)
         daqData.append(channelData)
     return(daqData)
 
+def acquireAll():
+    # Reads all the digitizers, one worker per chassis. Returned in the order
+    # the digitizers appear in the configuration.
+    def acquireChassis(chassis, modules):
+        return {id(module): getDigData(module) for module in modules
+                if module.model == 'M3102A'}
+    chassisData = forEachChassis(acquireChassis)
+    digData = []
+    for module in config.modules:
+        if module.model == 'M3102A':
+            digData.append(chassisData[module.chassis][id(module)])
+    return digData
+
 def getDigData(module):
-    LSB = 1 / 2**14
+    # As getDigDataRaw, converted from digitizer counts to V
     samples = getDigDataRaw(module)
     for daqData in samples:
-        for channelData in daqData:
-            channelData = channelData * LSB
+        if isinstance(daqData, CaptureStatistics):
+            daqData.scale(DIG_VOLTS_PER_COUNT)
+            continue
+        for ii, channelData in enumerate(daqData):
+            daqData[ii] = np.asarray(channelData) * DIG_VOLTS_PER_COUNT
     return(samples)
       
 
@@ -421,11 +708,37 @@ def calcAandB(f, fs=1E9):
     B = round((K-A) * 5**10) 
     return A, B
 
-def interweavePulses(pulses):
-    interweaved = np.zeros(len(pulses[0]) * 5)
-    for ii in range(len(pulses)):
-        interweaved[ii::5] = pulses[ii]
-    return interweaved
+def composeInterleaved(sampleRate, pulseDescriptor):
+    # Each LO runs at 1/5 of the AWG sample rate, and its samples occupy every
+    # fifth slot of the waveform. Allocate the (N, 5) buffer once and have each
+    # sub-pulse written (and carrier mixed) directly into its own column, so
+    # the flattened buffer is the interleaved waveform with no further copies.
+    loRate = sampleRate / 5
+    length = max(pulseLab.pulseLength(loRate,
+                                      pulse.width,
+                                      pulse.bandwidth,
+                                      pulseDescriptor.pri,
+                                      pulse.toa)
+                 for pulse in pulseDescriptor.pulses)
+    interleaved = np.zeros((length, 5))
+    carriers = []
+    columns = []
+    for ii, pulse in enumerate(pulseDescriptor.pulses):
+        column = interleaved[:, ii]
+        pulseLab.createPulse(loRate,
+                             pulse.width,
+                             pulse.bandwidth,
+                             pulse.amplitude / MAX_CHANNEL_AMPLITUDE,
+                             pulseDescriptor.pri,
+                             pulse.toa,
+                             out=column)
+        if pulse.carrier != 0:
+            carriers.append(pulse.carrier)
+            columns.append(column)
+    # All the sub-pulse carriers are mixed in together, in one pass
+    if carriers:
+        pulseLab.ncoTones(loRate, carriers, out=columns)
+    return interleaved.reshape(-1)
 
     
 if (__name__ == '__main__'):
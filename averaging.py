@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Running statistics over repeated digitizer captures, so that averaged
+acquisitions only need memory for one capture's worth of points.
+
+@author: gumcbrid
+"""
+
+import numpy as np
+
+
+class CaptureStatistics:
+    def __init__(self, points, minMax=False, keepRaw=False):
+        self.counts = np.zeros(points, dtype=int)
+        self.sum = np.zeros(points)
+        self.sumSquares = np.zeros(points)
+        self._scratch = np.empty(points)
+        if minMax:
+            self.min = np.full(points, np.inf)
+            self.max = np.full(points, -np.inf)
+        else:
+            self.min = None
+            self.max = None
+        # Raw captures are only kept when explicitly asked for
+        self.raw = [] if keepRaw else None
+
+    def add(self, capture):
+        # Short captures (e.g. a timed out read) only contribute to the points
+        # they cover.
+        n = min(len(capture), len(self.sum))
+        capture = capture[:n]
+        self.counts[:n] += 1
+        np.add(self.sum[:n], capture, out=self.sum[:n])
+        np.multiply(capture, capture, out=self._scratch[:n], dtype=float)
+        self.sumSquares[:n] += self._scratch[:n]
+        if self.min is not None:
+            np.minimum(self.min[:n], capture, out=self.min[:n])
+            np.maximum(self.max[:n], capture, out=self.max[:n])
+        if self.raw is not None:
+            self.raw.append(capture)
+
+    def scale(self, factor):
+        # Converts everything gathered so far to other units, e.g. from
+        # digitizer counts to V. factor must be positive.
+        self.sum *= factor
+        self.sumSquares *= factor * factor
+        if self.min is not None:
+            self.min *= factor
+            self.max *= factor
+        if self.raw is not None:
+            self.raw = [capture * factor for capture in self.raw]
+
+    @property
+    def count(self):
+        return int(self.counts.max()) if len(self.counts) else 0
+
+    @property
+    def mean(self):
+        return self.sum / np.maximum(self.counts, 1)
+
+    @property
+    def variance(self):
+        mean = self.mean
+        variance = self.sumSquares / np.maximum(self.counts, 1) - mean * mean
+        return np.maximum(variance, 0.0)
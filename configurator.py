@@ -82,6 +82,9 @@ if (__name__ == '__main__'):
     #    #2 - The length of the pulse window 
     #            (must be long enough to hold all pulse enelopes, with transition times)
     #    #3 - List of SubPulseDescriptor details - to maximum of 5.
+    #    coherent= - True to allow a CW pulse (on for the whole window) to be
+    #            loaded as a short repeated tone segment, without the filtered
+    #            edges at the window boundaries (default False)
     pulseDescriptor1 = PulseDescriptor(1, 60e-06, pulseGroup)
     pulseDescriptor2 = PulseDescriptor(2, 60e-06, pulseGroup2)
     
@@ -101,6 +104,9 @@ if (__name__ == '__main__'):
     #    #1 - Channel
     #    #2 - Capture Period
     #    #3 - Trigger (False = auto, True = trigger from SW/HVI)
+    #    average= - True to keep only running statistics of the captures
+    #    minMax= - With average, also keep the per-point min and max
+    #    keepRaw= - With average, also keep every capture
     daq1 = DaqDescriptor(1, 100e-06, repeats, True)
     
     # AwgDescriptor:
@@ -112,6 +118,7 @@ if (__name__ == '__main__'):
     #    #6 - List of LoDescriptor details
     #    #7 - List of PulseDescriptor details
     #    #8 - List of queues (up to number of channels)
+    #    chassis= - Chassis number, in which the module is installed (default 1)
 
     # DigDescriptor:
     #    #1 - Model Number
@@ -119,8 +126,8 @@ if (__name__ == '__main__'):
     #    #3 - Sample Rate of module
     #    #4 - Slot Number, in which the module is installed
     #    #5 - FPGA details
-    #    #6 - 
-    #    #7 - 
+    #    #6 - List of DaqDescriptor details
+    #    chassis= - Chassis number, in which the module is installed (default 1)
     awg1 = AwgDescriptor("M3202A", 4, 1E09, 2, fpga, [los1], 
                          [pulseDescriptor1, pulseDescriptor2], 
                          [queue1, queue2])
@@ -141,6 +148,7 @@ if (__name__ == '__main__'):
     #    #1 - HVI file name to load
     #    #2 - List of HviConstants
     #    #3 - Slot number of module to be mapped to
+    #    chassis= - Chassis number of module to be mapped to (default 1)
     hvi = Hvi("quadLO.HVI", 
               [HviModule("AWG0",
                          [HviConstant("NumLoops", repeats, ""),
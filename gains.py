@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Planning of which waveforms have their amplitude applied by the AWG channel
+amplitude rather than baked into their samples. Pure functions of the pulse
+descriptors and queues, with no SD1 calls.
+
+@author: gumcbrid
+"""
+
+# Largest output amplitude that channelAmplitude accepts, in V
+MAX_CHANNEL_AMPLITUDE = 1.5
+
+
+def waveAliases(pulseDescriptors):
+    # Maps each waveform ID onto the first ID that describes identical content,
+    # so duplicates are only synthesized and loaded once.
+    aliases = {}
+    seen = []
+    for pulseDescriptor in pulseDescriptors:
+        content = (pulseDescriptor.pri, pulseDescriptor.pulses, pulseDescriptor.coherent)
+        for waveId, other in seen:
+            if other == content:
+                aliases[pulseDescriptor.id] = waveId
+                break
+        else:
+            seen.append((pulseDescriptor.id, content))
+            aliases[pulseDescriptor.id] = pulseDescriptor.id
+    return aliases
+
+
+def hardwareGains(pulseDescriptors, queues):
+    # Channels whose queues only play single-pulse waveforms, all of the same
+    # positive amplitude, have that amplitude applied by channelAmplitude and
+    # their waveforms synthesized at full scale. Amplitude changes to those
+    # waveforms then only need the channel amplitude changing, not a new
+    # waveform. Everything else has its amplitude baked into the samples.
+    # A waveform is loaded once however many channels play it, so a channel
+    # only gets a gain if none of its waveforms is baked for another channel.
+    # Returns ({channel: amplitude}, set of normalized waveform IDs), where the
+    # IDs are those of waveAliases, i.e. the IDs actually synthesized.
+    descriptors = {pulseDescriptor.id: pulseDescriptor for pulseDescriptor in pulseDescriptors}
+    aliases = waveAliases(pulseDescriptors)
+    candidates = {}
+    baked = set()
+    for queue in queues:
+        roots = set(aliases.get(item.pulse_id, item.pulse_id) for item in queue.items)
+        amplitudes = set()
+        for item in queue.items:
+            pulseDescriptor = descriptors.get(item.pulse_id)
+            if pulseDescriptor is None or len(pulseDescriptor.pulses) != 1:
+                amplitudes = None
+                break
+            amplitudes.add(pulseDescriptor.pulses[0].amplitude)
+        if (amplitudes is not None and len(amplitudes) == 1
+                and 0 < min(amplitudes) <= MAX_CHANNEL_AMPLITUDE):
+            candidates[queue.channel] = (amplitudes.pop(), roots)
+        else:
+            baked.update(roots)
+    # A candidate sharing a waveform with a baked channel has to be baked too,
+    # which can in turn bake more candidates, so repeat until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for channel, (amplitude, roots) in list(candidates.items()):
+            if roots & baked:
+                baked.update(roots)
+                del candidates[channel]
+                changed = True
+    gains = {channel: amplitude for channel, (amplitude, roots) in candidates.items()}
+    normalized = set()
+    for amplitude, roots in candidates.values():
+        normalized.update(roots)
+    return gains, normalized
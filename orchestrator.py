@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a set of blocking steps as a dependency graph, overlapping any steps
+whose dependencies allow it, and reports the critical path of each run.
+
+@author: gumcbrid
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Task:
+    name : str
+    function : object
+    dependencies : [str] = field(default_factory=list)
+    result : object = None
+    start : float = 0
+    end : float = 0
+
+
+class Orchestrator:
+    def __init__(self, max_workers=None):
+        self.tasks = {}
+        self.max_workers = max_workers
+
+    def add(self, name, function, dependencies=()):
+        # function is called with no arguments, in an executor thread, once
+        # every task named in dependencies has completed.
+        if name in self.tasks:
+            raise ValueError("Duplicate task: {}".format(name))
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise ValueError("Task {} depends on unknown task {}".format(name,
+                                                                             dependency))
+        self.tasks[name] = Task(name, function, list(dependencies))
+        return name
+
+    def run(self):
+        self.origin = time.perf_counter()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._run())
+        else:
+            # Called from inside a running event loop (e.g. an IPython or
+            # Spyder console), where asyncio.run is not allowed, so run on a
+            # thread of its own with its own loop.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(asyncio.run, self._run()).result()
+        for line in self.criticalPath():
+            log.info(line)
+        return {name: task.result for name, task in self.tasks.items()}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            async def runTask(task):
+                for dependency in task.dependencies:
+                    await futures[dependency]
+                task.start = time.perf_counter() - self.origin
+                task.result = await loop.run_in_executor(executor, task.function)
+                task.end = time.perf_counter() - self.origin
+            # Tasks can only depend on tasks added before them, so creating
+            # them in order means every dependency already has a future.
+            for task in self.tasks.values():
+                futures[task.name] = asyncio.ensure_future(runTask(task))
+            await asyncio.gather(*futures.values())
+
+    def criticalPath(self):
+        # Walks back from the last task to finish, through whichever
+        # dependency finished last at each step.
+        if not self.tasks:
+            return []
+        task = max(self.tasks.values(), key=lambda task: task.end)
+        path = [task]
+        while task.dependencies:
+            task = max((self.tasks[name] for name in task.dependencies),
+                       key=lambda task: task.end)
+            path.append(task)
+        lines = ["Critical path: {:.3f}s".format(path[0].end)]
+        for task in reversed(path):
+            lines.append("  {:8.3f}s - {:8.3f}s  {}".format(task.start,
+                                                           task.end,
+                                                           task.name))
+        return lines
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Plotting of digitizer captures, decimated to screen resolution and limited to
+a fixed number of traces so the time taken does not grow with captureCount.
+Renders headless to a file by default; matplotlib is only imported when a
+plot is actually made.
+
+@author: gumcbrid
+"""
+
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def minMaxDecimate(wave, buckets):
+    # Keeps the minimum and maximum of each bucket, so narrow features are
+    # still visible at screen resolution.
+    wave = np.asarray(wave)
+    if len(wave) <= 2 * buckets:
+        return np.arange(len(wave)), wave
+    starts = np.linspace(0, len(wave), buckets + 1).astype(int)[:-1]
+    x = np.repeat(starts, 2)
+    y = np.empty(2 * buckets, dtype=wave.dtype)
+    y[0::2] = np.minimum.reduceat(wave, starts)
+    y[1::2] = np.maximum.reduceat(wave, starts)
+    return x, y
+
+
+def lttbDecimate(wave, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the first and last points and,
+    # from each bucket in between, the point forming the largest triangle
+    # with the previously kept point and the average of the next bucket.
+    wave = np.asarray(wave)
+    n = len(wave)
+    if threshold >= n or threshold < 3:
+        return np.arange(n), wave
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    x = np.empty(threshold, dtype=int)
+    x[0] = 0
+    x[-1] = n - 1
+    previous = 0
+    for ii in range(threshold - 2):
+        start, stop = edges[ii], edges[ii + 1]
+        if ii + 2 < len(edges):
+            nextStart, nextStop = edges[ii + 1], edges[ii + 2]
+        else:
+            nextStart, nextStop = n - 1, n
+        averageX = (nextStart + nextStop - 1) / 2
+        averageY = wave[nextStart:nextStop].mean()
+        candidates = np.arange(start, stop)
+        areas = np.abs((previous - averageX) * (wave[candidates] - wave[previous])
+                       - (previous - candidates) * (averageY - wave[previous]))
+        previous = candidates[np.argmax(areas)]
+        x[ii + 1] = previous
+    return x, wave[x]
+
+
+def selectCaptures(count, maxTraces, page=None):
+    # With no page, an evenly spaced subset spanning all the captures.
+    if page is None:
+        if count <= maxTraces:
+            return list(range(count))
+        return list(np.unique(np.linspace(0, count - 1, maxTraces).astype(int)))
+    return list(range(page * maxTraces, min(count, (page + 1) * maxTraces)))
+
+
+def plotCaptures(digData, filename='captures.png', width=1000, maxTraces=16,
+                 page=None, method='minmax', show=False):
+    # digData: as returned by QuadLO.acquireAll, a list per digitizer of a list
+    # per DAQ of captures. One subplot per DAQ, with up to maxTraces captures
+    # overlaid, each decimated to width points.
+    channels = [captures for daqData in digData for captures in daqData]
+    if len(channels) == 0:
+        return None
+    if method == 'lttb':
+        decimate = lttbDecimate
+    else:
+        decimate = minMaxDecimate
+        width = width // 2
+    if show:
+        import matplotlib.pyplot as plt
+        figure = plt.figure()
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure()
+        FigureCanvasAgg(figure)
+    for ii, captures in enumerate(channels):
+        axes = figure.add_subplot(len(channels), 1, ii + 1)
+        if hasattr(captures, 'mean'):
+            # Averaged acquisition, see averaging.CaptureStatistics
+            x, y = decimate(captures.mean, width)
+            axes.plot(x, y, linewidth=0.5)
+            if captures.min is not None:
+                for extreme in (captures.min, captures.max):
+                    x, y = decimate(extreme, width)
+                    axes.plot(x, y, linewidth=0.5, color='grey')
+            axes.set_title("DAQ {}: mean of {} captures".format(ii, captures.count))
+            continue
+        selected = selectCaptures(len(captures), maxTraces, page)
+        for capture in selected:
+            x, y = decimate(captures[capture], width)
+            axes.plot(x, y, linewidth=0.5)
+        axes.set_title("DAQ {}: {} of {} captures".format(ii,
+                                                          len(selected),
+                                                          len(captures)))
+    figure.tight_layout()
+    if show:
+        plt.show()
+    else:
+        figure.savefig(filename)
+        log.info("Saved capture plot: %s", filename)
+    return figure
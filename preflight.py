@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Offline checks of a Configuration against itself and the HVI project file,
+so that bad configurations fail before any SD1 call rather than after the
+FPGA loads and waveform uploads.
+
+@author: gumcbrid
+"""
+
+import os
+import re
+import struct
+import sys
+import logging
+
+import pulses as pulseLab
+import Configuration
+
+log = logging.getLogger(__name__)
+
+MAX_SUB_PULSES = 5
+MAX_STRING = 256
+
+
+class PreflightError(Exception):
+    pass
+
+
+def readHviProject(file_name):
+    # The .HVIprj file is binary, but every name in it is stored as a 32 bit
+    # little endian length followed by the characters. Each module appears as
+    # its name, two index strings, its model and its option string, followed
+    # by its constants and then its registers ('Register N') and flow chart.
+    # Returns {module name: (model, [constant names])}.
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    strings = []
+    ii = 0
+    while ii + 4 <= len(data):
+        length = struct.unpack_from('<I', data, ii)[0]
+        if 0 < length <= MAX_STRING and ii + 4 + length <= len(data):
+            text = data[ii + 4:ii + 4 + length]
+            if all(32 <= c < 127 for c in text):
+                strings.append(text.decode('ascii'))
+                ii += 4 + length
+                continue
+        ii += 1
+    modules = {}
+    for jj, text in enumerate(strings):
+        if re.fullmatch(r'M\d{4}[A-Z]', text) and jj >= 3:
+            name = strings[jj - 3]
+            constants = []
+            for constant in strings[jj + 2:]:
+                if constant.startswith('Register ') or constant == 'Start':
+                    break
+                constants.append(constant)
+            modules[name] = (text, constants)
+    return modules
+
+
+def waveformLength(sampleRate, pulseDescriptor):
+    # Length in samples, without synthesizing it
+    if len(pulseDescriptor.pulses) > 1:
+        return 5 * max(pulseLab.pulseLength(sampleRate / 5,
+                                            pulse.width,
+                                            pulse.bandwidth,
+                                            pulseDescriptor.pri,
+                                            pulse.toa)
+                       for pulse in pulseDescriptor.pulses)
+    pulse = pulseDescriptor.pulses[0]
+    return pulseLab.pulseLength(sampleRate,
+                                pulse.width,
+                                pulse.bandwidth,
+                                pulseDescriptor.pri,
+                                pulse.toa)
+
+
+def checkModules(config):
+    problems = []
+    locations = {}
+    for module in config.modules:
+        location = (module.chassis, module.slot)
+        if location in locations:
+            problems.append("Chassis {} slot {} is used by more than one module".format(*location))
+        locations[location] = module
+    return problems, locations
+
+
+def checkHvi(config, locations, project):
+    problems = []
+    for hviModule in config.hvi.hviModules:
+        module = locations.get((hviModule.chassis, hviModule.slot))
+        if module is None:
+            problems.append("HVI module {} is mapped to chassis {} slot {}, "
+                            "which has no module".format(hviModule.name,
+                                                         hviModule.chassis,
+                                                         hviModule.slot))
+        if project is None:
+            continue
+        if hviModule.name not in project:
+            problems.append("HVI module {} is not in the HVI project "
+                            "(which has {})".format(hviModule.name, sorted(project)))
+            continue
+        model, constants = project[hviModule.name]
+        if module is not None and module.model != model:
+            problems.append("HVI module {} is an {} but chassis {} slot {} "
+                            "is an {}".format(hviModule.name, model,
+                                              hviModule.chassis, hviModule.slot,
+                                              module.model))
+        for constant in hviModule.constants:
+            if constant.name not in constants:
+                problems.append("HVI module {} has no constant {} "
+                                "(it has {})".format(hviModule.name, constant.name,
+                                                     constants))
+    if project is not None:
+        mapped = set(hviModule.name for hviModule in config.hvi.hviModules)
+        for name in project:
+            if name not in mapped:
+                problems.append("HVI project module {} is not mapped to any "
+                                "module".format(name))
+    return problems
+
+
+def checkAwg(module):
+    problems = []
+    where = "{} in chassis {} slot {}".format(module.model, module.chassis, module.slot)
+    ids = [pulseDescriptor.id for pulseDescriptor in module.pulseDescriptors]
+    for waveId in set(ids):
+        if ids.count(waveId) > 1:
+            problems.append("{}: waveform ID {} is defined more than once".format(where,
+                                                                                 waveId))
+    queued = set()
+    for queue in module.queues:
+        if not 1 <= queue.channel <= module.channels:
+            problems.append("{}: queue on channel {}, which does not exist".format(where,
+                                                                                  queue.channel))
+        for item in queue.items:
+            queued.add(item.pulse_id)
+            if item.pulse_id not in ids:
+                problems.append("{}: channel {} queues waveform ID {}, which is "
+                                "not defined".format(where, queue.channel, item.pulse_id))
+    total = 0
+    for pulseDescriptor in module.pulseDescriptors:
+        what = "{}: waveform ID {}".format(where, pulseDescriptor.id)
+        if pulseDescriptor.id not in queued:
+            problems.append("{} is not used by any queue".format(what))
+        if not 1 <= len(pulseDescriptor.pulses) <= MAX_SUB_PULSES:
+            problems.append("{} has {} sub-pulses, must be 1 to {}".format(
+                    what, len(pulseDescriptor.pulses), MAX_SUB_PULSES))
+            continue
+        amplitude = sum(abs(pulse.amplitude) for pulse in pulseDescriptor.pulses)
+        if amplitude > 1.0:
+            problems.append("{} has a total amplitude of {}, must be no more "
+                            "than 1.0".format(what, amplitude))
+        # Checked in the samples createPulse builds, as toa + width can land
+        # a rounding error beyond a pri it exactly fills.
+        if len(pulseDescriptor.pulses) > 1:
+            rate = module.sample_rate / 5
+        else:
+            rate = module.sample_rate
+        for pulse in pulseDescriptor.pulses:
+            leadIn, width, leadOut = pulseLab.pulseSegments(rate,
+                                                            pulse.width,
+                                                            pulse.bandwidth,
+                                                            pulseDescriptor.pri,
+                                                            pulse.toa)
+            if leadIn < 0 or leadOut < 0:
+                problems.append("{} has a sub-pulse at {}s for {}s, outside its "
+                                "{}s window".format(what, pulse.toa, pulse.width,
+                                                    pulseDescriptor.pri))
+        total += waveformLength(module.sample_rate, pulseDescriptor)
+    if total > Configuration.AWG_MEMORY_SAMPLES:
+        problems.append("{}: waveforms need {} samples, more than the {} "
+                        "available".format(where, total, Configuration.AWG_MEMORY_SAMPLES))
+    return problems
+
+
+def checkDig(module):
+    problems = []
+    for daq in module.daqs:
+        if not 1 <= daq.channel <= module.channels:
+            problems.append("{} in chassis {} slot {}: acquisition on channel {}, "
+                            "which does not exist".format(module.model, module.chassis,
+                                                          module.slot, daq.channel))
+    return problems
+
+
+def check(config, projectFile='QuadLO.HVIprj'):
+    # Returns a list of problems, empty if the configuration is good
+    problems, locations = checkModules(config)
+    project = None
+    if projectFile is not None:
+        if os.path.exists(projectFile):
+            project = readHviProject(projectFile)
+        else:
+            problems.append("HVI project {} not found".format(projectFile))
+    problems += checkHvi(config, locations, project)
+    for module in config.modules:
+        if module.model == 'M3202A':
+            problems += checkAwg(module)
+        elif module.model == 'M3102A':
+            problems += checkDig(module)
+    return problems
+
+
+def preflight(config, projectFile='QuadLO.HVIprj'):
+    problems = check(config, projectFile)
+    for problem in problems:
+        log.error("Preflight: %s", problem)
+    if problems:
+        raise PreflightError("{} configuration problems found".format(len(problems)))
+    log.info("Preflight: configuration OK")
+
+
+if (__name__ == '__main__'):
+    if len(sys.argv) > 1:
+        configName = sys.argv[1]
+    else:
+        configName = 'latest'
+    preflight(Configuration.loadConfig(configName))
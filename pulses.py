@@ -12,9 +12,40 @@ import time
 import numpy as np
 from scipy import signal
 from scipy import io as sio
-from collections import namedtuple as namedtuple
+from fractions import Fraction
+from functools import lru_cache
 
-Waveform = namedtuple('Waveform', 'wave, timebase')
+class Waveform:
+    # Samples plus what is needed to work out their timebase, which is only
+    # built (and not kept) when asked for. An explicit timebase array can
+    # still be given, as with the namedtuple this replaces, and a Waveform
+    # still unpacks as (wave, timebase).
+    __slots__ = ('wave', 'sampleRate', 'start', '_timebase')
+
+    def __init__(self, wave, timebase=None, sampleRate=None, start=0):
+        if timebase is None and sampleRate is None:
+            raise ValueError("Waveform needs either a timebase or a sampleRate")
+        self.wave = wave
+        self.sampleRate = sampleRate
+        self.start = start
+        self._timebase = timebase
+
+    @property
+    def timebase(self):
+        if self._timebase is not None:
+            return self._timebase
+        return self.start + np.arange(len(self.wave)) / self.sampleRate
+
+    def __iter__(self):
+        return iter((self.wave, self.timebase))
+
+    def __getitem__(self, index):
+        return (self.wave, self.timebase)[index]
+
+    def __repr__(self):
+        return "Waveform({} samples, sampleRate={}, start={})".format(len(self.wave),
+                                                                     self.sampleRate,
+                                                                     self.start)
 
 
 def timebase(start, stop, sample_rate):
@@ -25,12 +56,20 @@ def timebase(start, stop, sample_rate):
     return(timebase)
 
 
-def filterWave(sampleRate, bandwidth, wave):
+@lru_cache(maxsize=64)
+def gaussianKernel(sampleRate, bandwidth):
+    # Cached, as batches of pulses commonly share a bandwidth. Not to be
+    # modified by callers.
     superRate = 10 * sampleRate
     dx = 1 / superRate
     sigma = 0.3 / bandwidth
     gx = np.arange(-3*sigma, 3*sigma, dx)
     gaussian = np.exp(-(gx/sigma)**2/2)
+    return gaussian
+
+
+def filterWave(sampleRate, bandwidth, wave):
+    gaussian = gaussianKernel(sampleRate, bandwidth)
     filtered = signal.fftconvolve(wave, gaussian, mode="full") / np.sum(gaussian)
     filtered = filtered[(int(len(gaussian) / 2)):(-1*int(len(gaussian) / 2)) + 1]
     normalize = np.max(wave) / np.max(filtered)
@@ -57,11 +96,12 @@ def createPulseTrain(sampleRate, pulseWidth, repRate, pulseTrain, bandwidth):
     wave = createIdealPulseTrain(sampleRate, pulseWidth, repRate, pulseTrain)
     filteredWave = filterWave(sampleRate, bandwidth, wave)
     awgWave = signal.decimate(filteredWave, 10)
-    t = timebase(0, len(awgWave) / sampleRate, sampleRate)
-    return Waveform(awgWave, t)
+    return Waveform(awgWave, sampleRate=sampleRate)
 
 
-def createPulse(sampleRate, pulseWidth, bandwidth, amplitude=1, period=0, offset=0):
+def pulseSegments(sampleRate, pulseWidth, bandwidth, period=0, offset=0):
+    # Lengths of the lead in, pulse and lead out of the ideal pulse, in
+    # samples at the 20x super sampled rate createPulse builds it at.
     superRate = 20 * sampleRate
     # If no period is given,
     # We need to create a significantly larger wave than the pulse width to
@@ -75,15 +115,84 @@ def createPulse(sampleRate, pulseWidth, bandwidth, amplitude=1, period=0, offset
         leadInSamples = int(leadIn * superRate)
         leadOut = period - offset - pulseWidth
         leadOutSamples = int(leadOut * superRate)
+    return leadInSamples, int(pulseWidth * superRate), leadOutSamples
+
+
+def pulseLength(sampleRate, pulseWidth, bandwidth, period=0, offset=0):
+    # Number of AWG rate samples that createPulse will produce for the same
+    # arguments, without doing any of the synthesis. Used to size output
+    # buffers up front.
+    superSamples = sum(pulseSegments(sampleRate, pulseWidth, bandwidth, period, offset))
+    gaussianSamples = len(gaussianKernel(sampleRate, bandwidth))
+    filteredSamples = superSamples + gaussianSamples - 2 * int(gaussianSamples / 2)
+    return int(np.ceil(filteredSamples / 20))
+
+
+def createPulse(sampleRate, pulseWidth, bandwidth, amplitude=1, period=0, offset=0,
+                out=None):
+    # If 'out' is given, the pulse is written directly into it (e.g. a column
+    # view of an interleaved buffer) rather than into a newly allocated array.
+    # Any samples beyond the end of the pulse are zeroed.
+    leadInSamples, pulseSamples, leadOutSamples = pulseSegments(sampleRate,
+                                                                pulseWidth,
+                                                                bandwidth,
+                                                                period,
+                                                                offset)
     wave = np.concatenate([np.zeros(leadInSamples), 
-                           np.ones(int(pulseWidth * superRate)), 
+                           np.ones(pulseSamples), 
                            np.zeros(leadOutSamples)])
     filteredWave = filterWave(sampleRate, bandwidth , wave)
     awgWave = signal.decimate(filteredWave, 20)
-    awgWave = awgWave * amplitude
-    t = np.arange(0, len(awgWave))
-    t = t / sampleRate
-    return Waveform(awgWave, t)
+    if out is None:
+        awgWave = awgWave * amplitude
+    else:
+        n = min(len(out), len(awgWave))
+        np.multiply(awgWave[:n], amplitude, out=out[:n])
+        out[n:] = 0.0
+        awgWave = out
+    return Waveform(awgWave, sampleRate=sampleRate)
+
+
+def createPulses(sampleRate, pulseWidths, bandwidths, amplitudes=1, period=0, offsets=0,
+                 maxElements=2**24):
+    # Batch version of createPulse: the arguments may be arrays (broadcast
+    # against each other) and the result is a 2D array with one AWG rate
+    # envelope per row, zero padded to the longest. Pulses sharing a bandwidth
+    # share one filter kernel and are filtered and decimated together, in
+    # batches of at most maxElements super sampled points.
+    # Rows padded beyond their own length can differ from createPulse by the
+    # decimation filter's edge effects in their last few samples.
+    pulseWidths, bandwidths, amplitudes, offsets = np.broadcast_arrays(
+            np.atleast_1d(pulseWidths),
+            np.atleast_1d(bandwidths),
+            np.atleast_1d(amplitudes),
+            np.atleast_1d(offsets))
+    segments = [pulseSegments(sampleRate, width, bandwidth, period, offset)
+                for width, bandwidth, offset in zip(pulseWidths, bandwidths, offsets)]
+    lengths = [pulseLength(sampleRate, width, bandwidth, period, offset)
+               for width, bandwidth, offset in zip(pulseWidths, bandwidths, offsets)]
+    pulses = np.zeros((len(pulseWidths), max(lengths)))
+    for bandwidth in np.unique(bandwidths):
+        gaussian = gaussianKernel(sampleRate, bandwidth)
+        half = int(len(gaussian) / 2)
+        group = np.flatnonzero(bandwidths == bandwidth)
+        superSamples = max(sum(segments[row]) for row in group)
+        batchSize = max(1, maxElements // superSamples)
+        for start in range(0, len(group), batchSize):
+            rows = group[start:start + batchSize]
+            ideal = np.zeros((len(rows), superSamples))
+            for ii, row in enumerate(rows):
+                leadInSamples, pulseSamples, _ = segments[row]
+                ideal[ii, leadInSamples:leadInSamples + pulseSamples] = 1.0
+            filtered = signal.fftconvolve(ideal, gaussian[np.newaxis, :],
+                                          mode="full", axes=1) / np.sum(gaussian)
+            filtered = filtered[:, half:filtered.shape[1] - half + 1]
+            filtered *= (ideal.max(axis=1) / filtered.max(axis=1))[:, np.newaxis]
+            awgWaves = signal.decimate(filtered, 20, axis=1)
+            for ii, row in enumerate(rows):
+                n = min(lengths[row], awgWaves.shape[1])
+                pulses[row, :n] = awgWaves[ii, :n] * amplitudes[row]
+    return pulses
 
 
 def createTone(sampleRate, frequency, phase, timebase):
@@ -91,6 +200,132 @@ def createTone(sampleRate, frequency, phase, timebase):
     return wave
 
 
+# Sine lookup table for the NCO, indexed by the top bits of a 64 bit phase
+# accumulator. 2**18 entries keeps the lookup error below one 16 bit LSB.
+SINE_TABLE_BITS = 18
+
+
+@lru_cache(maxsize=None)
+def sineTable(bits=SINE_TABLE_BITS):
+    return np.sin(2 * np.pi * np.arange(2**bits) / 2**bits)
+
+
+def phaseWord(cycles):
+    # A phase, in cycles, as a 64 bit accumulator value
+    return int(round(Fraction(cycles) * 2**64)) % 2**64
+
+
+def ncoTones(sampleRate, frequencies, phases=None, out=None, length=None,
+             chunk=2**16):
+    # Generates sin(2*pi*f*n/sampleRate + phase) for several carriers in one
+    # pass, from a phase accumulator and a cached sine table rather than
+    # evaluating np.sin over a float timebase. Phases are in degrees.
+    # If out is given (a 2D array, or a sequence of equal length 1D arrays
+    # such as column views, one per carrier) it is multiplied by the carriers
+    # in place. Otherwise a new (len(frequencies), length) array of the
+    # carriers is returned. Work is done in chunks to bound the temporaries.
+    if phases is None:
+        phases = [0] * len(frequencies)
+    table = sineTable()
+    shift = np.uint64(64 - SINE_TABLE_BITS)
+    steps = np.array([phaseWord(Fraction(f) / Fraction(sampleRate)) for f in frequencies],
+                     dtype=np.uint64)[:, np.newaxis]
+    # Half a table step is added so that truncating to the table index rounds
+    offsets = np.array([(phaseWord(Fraction(p) / 360) + 2**(63 - SINE_TABLE_BITS)) % 2**64
+                        for p in phases],
+                       dtype=np.uint64)[:, np.newaxis]
+    if out is None:
+        out = np.empty((len(frequencies), length))
+        fill = True
+    else:
+        length = len(out[0])
+        fill = False
+    for start in range(0, length, chunk):
+        stop = min(start + chunk, length)
+        accumulator = np.arange(start, stop, dtype=np.uint64) * steps
+        accumulator += offsets
+        accumulator >>= shift
+        tones = table[accumulator]
+        for ii in range(len(frequencies)):
+            if fill:
+                out[ii][start:stop] = tones[ii]
+            else:
+                out[ii][start:stop] *= tones[ii]
+    return out
+
+
+def applyTone(sampleRate, frequency, phase, wave):
+    # Multiplies 'wave' by the carrier in place, starting at sample 0.
+    ncoTones(sampleRate, [frequency], [phase], out=[wave])
+    return wave
+
+
+def coherentLength(sampleRate, frequencies, granularity=1, maxLength=2**24):
+    # The shortest number of samples, a multiple of granularity, after which
+    # all the given carriers return to the same phase, so a waveform of this
+    # length can be replayed back to back with no phase discontinuity.
+    # Frequencies only need to be exact to within a phase error of 1e-6 cycles
+    # over maxLength samples, to allow for floating point representation.
+    # Returns None if no period within maxLength exists.
+    length = granularity
+    for frequency in frequencies:
+        ratio = (Fraction(frequency) / Fraction(sampleRate)).limit_denominator(maxLength)
+        if abs(float(ratio) - frequency / sampleRate) * maxLength > 1e-6:
+            return None
+        length = np.lcm(length, ratio.denominator)
+        if length > maxLength:
+            return None
+    return int(length)
+
+
+# Candidate lengths suggestCoherentFrequency evaluates at a time, to bound memory
+SUGGEST_BLOCK = 2**20
+
+
+def suggestCoherentFrequency(sampleRate, frequency, maxLength, granularity=1):
+    # The nearest frequency to the one given that repeats within maxLength
+    # samples. Returns (frequency, length), preferring the shortest length
+    # among equally close frequencies.
+    best = None
+    step = granularity * SUGGEST_BLOCK
+    for first in range(granularity, maxLength + 1, step):
+        lengths = np.arange(first, min(first + step, maxLength + 1), granularity)
+        coherent = np.round(frequency * lengths / sampleRate) * sampleRate / lengths
+        # argmin takes the first, so the shortest, of equally close lengths
+        ii = np.argmin(np.abs(coherent - frequency))
+        if best is None or abs(coherent[ii] - frequency) < abs(best[0] - frequency):
+            best = (float(coherent[ii]), int(lengths[ii]))
+    return best
+
+
+def createCoherentTone(sampleRate, frequencies, amplitudes, duration, granularity=1,
+                       phase=0):
+    # CW content as one phase continuous segment plus the number of cycles
+    # needed to fill duration, rather than a waveform of the full duration.
+    # Returns (Waveform, cycles), or None if the carriers have no short period.
+    length = coherentLength(sampleRate, frequencies, granularity)
+    if length is None:
+        return None
+    t = np.arange(length) / sampleRate
+    wave = np.zeros(length)
+    for frequency, amplitude in zip(frequencies, amplitudes):
+        wave += amplitude * createTone(sampleRate, frequency, phase, t)
+    cycles = max(1, int(np.round(duration * sampleRate / length)))
+    return Waveform(wave, sampleRate=sampleRate), cycles
+
+
+def trimZeros(wave, granularity=1, threshold=0.0):
+    # Returns (start, stop) such that wave[start:stop] holds everything above
+    # threshold, with the amount trimmed from each end a multiple of
+    # granularity samples.
+    active = np.flatnonzero(np.abs(wave) > threshold)
+    if len(active) == 0:
+        return 0, len(wave)
+    start = (active[0] // granularity) * granularity
+    stop = len(wave) - ((len(wave) - active[-1] - 1) // granularity) * granularity
+    return int(start), int(stop)
+
+
 def createCsv(sampleRate, filename, wave):
     rpts = int(np.lcm(len(wave), 128)/len(wave))
     f = open (filename, 'w')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Thin layer over the SD1 return codes: cheap checking, error counters, typed
+exceptions, and a fixed size ring buffer of recent calls for post-mortem.
+Error messages are only looked up if a log record is actually emitted.
+
+@author: gumcbrid
+"""
+
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Most recent calls as (time, name, result, context)
+EVENT_HISTORY = 1024
+events = collections.deque(maxlen=EVENT_HISTORY)
+# Failures counted by (name, error code)
+errorCounts = collections.Counter()
+# Raise SD1Error on failure rather than logging it and carrying on
+raiseOnError = False
+
+
+class ErrorMessage:
+    # Looks up the SD1 error text only when formatted into a log record
+    __slots__ = ('code',)
+
+    def __init__(self, code):
+        self.code = code
+
+    def __str__(self):
+        import keysightSD1 as key
+        return key.SD_Error.getErrorMessage(self.code)
+
+
+class SD1Error(Exception):
+    def __init__(self, name, code, context=()):
+        super().__init__(name, code, context)
+        self.name = name
+        self.code = code
+        self.context = context
+
+    def __str__(self):
+        return "{} failed - {}: {} {}".format(self.name,
+                                              self.code,
+                                              ErrorMessage(self.code),
+                                              self.context)
+
+
+def check(result, name, *context, level=logging.ERROR, raiseError=None):
+    # Returns result, so it can wrap a call inline:
+    #   error = sd1.check(awg.AWGstart(channel), 'AWGstart', channel)
+    events.append((time.perf_counter(), name, result, context))
+    if isinstance(result, int) and result < 0:
+        errorCounts[(name, result)] += 1
+        if raiseOnError if raiseError is None else raiseError:
+            raise SD1Error(name, result, context)
+        log.log(level, "%s failed - %s: %s %s", name, result, ErrorMessage(result), context)
+    return result
+
+
+def record(name, result, *context):
+    # For calls that return data rather than an error code. Only pass
+    # something small (e.g. a length) as the result, as it is kept in the
+    # history.
+    events.append((time.perf_counter(), name, result, context))
+
+
+def dumpEvents(level=logging.INFO):
+    if errorCounts:
+        log.log(level, "SD1 errors: %s", dict(errorCounts))
+    origin = events[0][0] if events else 0
+    for timestamp, name, result, context in events:
+        log.log(level, "%10.6f %s %s %s", timestamp - origin, name, result, context)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition from M3102A channels for an unbounded number of
+triggers. A reader thread per channel copies each capture into one of two
+preallocated blocks; when a block is full it is handed to a consumer thread
+while the reader carries on filling the other.
+
+@author: gumcbrid
+"""
+
+import sys
+import time
+import queue
+import logging
+import threading
+
+import numpy as np
+
+sys.path.append(r'C:\Program Files (x86)\Keysight\SD1\Libraries\Python')
+import keysightSD1 as key
+
+import sd1
+
+log = logging.getLogger(__name__)
+
+READ_TIMEOUT = 100   # ms, so the reader notices stop() promptly
+# Consecutive failed reads after which the reader gives up
+MAX_READ_FAILURES = 10
+
+
+class DaqStream:
+    def __init__(self, module, daq, callback, blockCaptures=64):
+        # callback(block) is called from the consumer thread with a
+        # (blockCaptures, points) int16 array, which is reused once the
+        # callback returns.
+        self.module = module
+        self.daq = daq
+        self.callback = callback
+        self.points = int(np.round(daq.captureTime * module.sample_rate))
+        self.blocks = np.zeros((2, blockCaptures, self.points), dtype=np.int16)
+        self.free = [threading.Event(), threading.Event()]
+        self.ready = queue.Queue()
+        self.samples = 0
+        self.captures = 0
+        self.shortReads = 0
+        self.readErrors = 0
+        self.overruns = 0
+        self.startTime = None
+        self.stopTime = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def throughput(self):
+        # Sustained rate in MS/s from start() until stop(), or until now if
+        # still running
+        if self.startTime is None:
+            return 0.0
+        end = self.stopTime if self.stopTime is not None else time.perf_counter()
+        return self.samples / (end - self.startTime) / 1E6
+
+    def start(self):
+        dig = self.module.handle
+        if self.daq.trigger:
+            trigger_mode = key.SD_TriggerModes.SWHVITRIG
+        else:
+            trigger_mode = key.SD_TriggerModes.AUTOTRIG
+        trigger_delay = int(np.round(self.daq.triggerDelay * self.module.sample_rate))
+        sd1.check(dig.DAQflush(self.daq.channel), 'DAQflush', self.module.slot, self.daq.channel)
+        # Zero cycles means acquire until stopped
+        sd1.check(dig.DAQconfig(self.daq.channel, self.points, 0, trigger_delay, trigger_mode),
+                  'DAQconfig', self.module.slot, self.daq.channel)
+        for event in self.free:
+            event.set()
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._read, daemon=True),
+                         threading.Thread(target=self._consume, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        self.stopTime = None
+        self.startTime = time.perf_counter()
+        sd1.check(dig.DAQstart(self.daq.channel), 'DAQstart', self.module.slot, self.daq.channel)
+
+    def stop(self):
+        sd1.check(self.module.handle.DAQstop(self.daq.channel), 'DAQstop',
+                  self.module.slot, self.daq.channel)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self.stopTime = time.perf_counter()
+        log.info("Stream slot %s channel %s: %s captures, %.1f MS/s, %s overruns, "
+                 "%s short reads, %s read errors",
+                 self.module.slot, self.daq.channel, self.captures, self.throughput,
+                 self.overruns, self.shortReads, self.readErrors)
+
+    def _read(self):
+        read = self.module.handle.DAQread
+        channel = self.daq.channel
+        active = 0
+        row = 0
+        # Samples of the current capture read so far. A read that times out
+        # part way through a capture leaves the rest to the next read, which
+        # carries on filling the same row.
+        filled = 0
+        failures = 0
+        self.free[active].clear()
+        try:
+            while not self._stop.is_set():
+                data = read(channel, self.points - filled, READ_TIMEOUT)
+                if isinstance(data, int):
+                    # DAQread returns an error code rather than data on failure
+                    sd1.check(data, 'DAQread', self.module.slot, channel, raiseError=False)
+                    self.readErrors += 1
+                    failures += 1
+                    if failures >= MAX_READ_FAILURES:
+                        log.error("Stream slot %s channel %s: stopping after %s "
+                                  "consecutive read errors",
+                                  self.module.slot, channel, failures)
+                        break
+                    continue
+                failures = 0
+                n = len(data)
+                if n == 0:
+                    continue
+                self.blocks[active, row, filled:filled + n] = data
+                filled += n
+                self.samples += n
+                if filled < self.points:
+                    continue
+                filled = 0
+                self.captures += 1
+                row += 1
+                if row == len(self.blocks[active]):
+                    self.ready.put(active)
+                    active = 1 - active
+                    row = 0
+                    if not self.free[active].is_set():
+                        # The consumer is still busy with the other block.
+                        # Wait for it (the module's own memory buffers
+                        # meanwhile), and count it so that a consumer too slow
+                        # to keep up shows.
+                        self.overruns += 1
+                        while not self.free[active].wait(READ_TIMEOUT / 1000):
+                            if self._stop.is_set():
+                                break
+                    self.free[active].clear()
+        finally:
+            # Always hand over what was read and the end marker, however the
+            # reader finished, so the consumer and stop() never wait for ever.
+            if filled:
+                # Capture cut short
+                self.shortReads += 1
+                self.blocks[active, row, filled:] = 0
+                row += 1
+            if row:
+                self.ready.put((active, row))
+            self.ready.put(None)
+
+    def _consume(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                break
+            if isinstance(item, tuple):
+                # Partly filled block left when the stream stopped
+                block, rows = item
+                self.callback(self.blocks[block, :rows])
+            else:
+                self.callback(self.blocks[item])
+                self.free[item].set()
+
+
+def startStreams(module, callback, blockCaptures=64):
+    # One stream per DaqDescriptor of an already configured digitizer.
+    # callback(daq, block) is called for each full block of captures.
+    streams = []
+    for daq in module.daqs:
+        stream = DaqStream(module,
+                           daq,
+                           lambda block, daq=daq: callback(daq, block),
+                           blockCaptures)
+        stream.start()
+        streams.append(stream)
+    return streams
+
+
+def stopStreams(streams):
+    for stream in streams:
+        stream.stop()
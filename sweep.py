@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps over a Configuration, keeping the modules and HVI live
+between points and only reconfiguring what each point actually changes.
+
+@author: gumcbrid
+"""
+
+import copy
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import QuadLO
+import sd1
+from averaging import CaptureStatistics
+
+log = logging.getLogger(__name__)
+
+# What has to be redone on the hardware when a parameter changes, cheapest
+# first. A point applies only the work for the categories that changed.
+HVI_CONSTANT = 'hvi'
+GAIN = 'gain'
+REGISTER = 'register'
+WAVEFORM = 'waveform'
+QUEUE = 'queue'
+
+
+@dataclass
+class SweepAxis:
+    # path: location of the parameter within the Config, as dot separated
+    #       attribute names and list indices, e.g.
+    #       'modules.0.loDescriptors.0.frequencies.1'
+    #       'modules.0.pulseDescriptors.0.pulses.0.amplitude'
+    #       'hvi.hviModules.0.constants.1.value'
+    # values: the values to step the parameter through
+    path : str
+    values : list
+
+
+def _steps(path):
+    return [int(step) if step.isdigit() else step for step in path.split('.')]
+
+
+def _getItem(obj, step):
+    if isinstance(step, int):
+        return obj[step]
+    return getattr(obj, step)
+
+
+def _setValue(root, steps, value):
+    obj = root
+    for step in steps[:-1]:
+        obj = _getItem(obj, step)
+    if isinstance(steps[-1], int):
+        obj[steps[-1]] = value
+    else:
+        setattr(obj, steps[-1], value)
+
+
+def classify(path):
+    steps = _steps(path)
+    if steps[0] == 'hvi':
+        if 'constants' not in steps:
+            raise ValueError("Only HVI constants can be swept: {}".format(path))
+        return (HVI_CONSTANT, None)
+    if steps[0] != 'modules' or len(steps) < 3:
+        raise ValueError("Unsupported sweep parameter: {}".format(path))
+    if steps[2] in ('loDescriptors', 'fpga'):
+        return (REGISTER, steps[1])
+    if steps[2] == 'pulseDescriptors':
+        return (WAVEFORM, steps[1])
+    if steps[2] == 'queues':
+        return (QUEUE, steps[1])
+    raise ValueError("Unsupported sweep parameter: {}".format(path))
+
+
+class Sweep:
+    def __init__(self, config, axes):
+        self.config = config
+        self.axes = axes
+        self.steps = [_steps(axis.path) for axis in axes]
+        self.categories = [classify(axis.path) for axis in axes]
+        for ii, axis in enumerate(axes):
+            if self._isGain(ii):
+                self.categories[ii] = (GAIN, self.categories[ii][1])
+        self.shape = tuple(len(axis.values) for axis in axes)
+        self.digitizers = [module for module in config.modules
+                           if module.model == 'M3102A']
+        daqs = [(module, daq) for module in self.digitizers
+                for daq in module.daqs]
+        if len(daqs) == 0:
+            raise ValueError("Sweep needs at least one digitizer acquisition")
+        # Averaged acquisitions store just their mean, as a single capture
+        sizes = set((1 if daq.average else daq.captureCount,
+                     int(np.round(daq.captureTime * module.sample_rate)))
+                    for module, daq in daqs)
+        if len(sizes) != 1:
+            raise ValueError("All acquisitions must have the same captureCount "
+                             "and number of points: {}".format(sizes))
+        self.results = np.zeros(self.shape + (len(daqs),) + sizes.pop())
+
+    def points(self):
+        return list(itertools.product(*[range(n) for n in self.shape]))
+
+    def run(self):
+        points = self.points()
+        self._setPoint(points[0])
+        QuadLO.config = self.config
+        QuadLO.bringUp()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                pending = None
+                previous = None
+                for n, point in enumerate(points):
+                    if previous is not None:
+                        waves = pending.result() if pending else {}
+                        self._apply(point, previous, waves)
+                    QuadLO.startHvi()
+                    # Synthesis for the next point runs while this point is
+                    # being acquired.
+                    pending = None
+                    if n + 1 < len(points):
+                        pending = executor.submit(self._synthesize,
+                                                  points[n + 1], point)
+                    self._acquire(point)
+                    previous = point
+        finally:
+            QuadLO.closeHvi()
+            QuadLO.closeModules()
+        return self.results
+
+    def _changed(self, point, previous):
+        return [ii for ii in range(len(self.axes)) if point[ii] != previous[ii]]
+
+    def _setPoint(self, point, axes=None):
+        if axes is None:
+            axes = range(len(self.axes))
+        for ii in axes:
+            _setValue(self.config, self.steps[ii], self.axes[ii].values[point[ii]])
+
+    def _isGain(self, ii):
+        # Amplitude of a waveform that has its amplitude applied by the
+        # channel amplitude, see QuadLO.hardwareGains
+        category, moduleIndex = self.categories[ii]
+        steps = self.steps[ii]
+        if category != WAVEFORM or steps[4:] != ['pulses', 0, 'amplitude']:
+            return False
+        if not all(0 < value <= QuadLO.MAX_CHANNEL_AMPLITUDE for value in self.axes[ii].values):
+            return False
+        module = self.config.modules[moduleIndex]
+        gains, normalized = QuadLO.hardwareGains(module.pulseDescriptors, module.queues)
+        aliases = QuadLO.waveAliases(module.pulseDescriptors)
+        return aliases[module.pulseDescriptors[steps[3]].id] in normalized
+
+    def _synthesize(self, point, previous):
+        # Works on copies of the pulse descriptors, as the live config still
+        # describes the point currently being acquired. Queue changes also
+        # need their waveforms reloaded, as the dead time trimmed from them
+        # depends on their position in the queue.
+        # Every changed axis of a module is applied to its copies, gain axes
+        # included, as the new waveforms must have the new amplitudes.
+        waves = {}
+        changed = self._changed(point, previous)
+        for moduleIndex in set(self.categories[ii][1] for ii in changed
+                               if self.categories[ii][0] in (WAVEFORM, QUEUE)):
+            waves[moduleIndex] = self._synthesizeModule(moduleIndex, point, changed)
+        return waves
+
+    def _synthesizeModule(self, moduleIndex, point, changed):
+        module = self.config.modules[moduleIndex]
+        pulseDescriptors = copy.deepcopy(module.pulseDescriptors)
+        queues = copy.deepcopy(module.queues)
+        for ii in changed:
+            if self.categories[ii] in ((WAVEFORM, moduleIndex), (GAIN, moduleIndex)):
+                _setValue(pulseDescriptors, self.steps[ii][3:],
+                          self.axes[ii].values[point[ii]])
+            elif self.categories[ii] == (QUEUE, moduleIndex):
+                _setValue(queues, self.steps[ii][3:],
+                          self.axes[ii].values[point[ii]])
+        # Returns (waves, normalized), as passed to QuadLO.uploadWaves
+        gains, normalized = QuadLO.hardwareGains(pulseDescriptors, queues)
+        return (QuadLO.synthesizeWaves(module.sample_rate, pulseDescriptors, normalized),
+                normalized)
+
+    def _apply(self, point, previous, waves):
+        changed = self._changed(point, previous)
+        self._setPoint(point, changed)
+        work = {}
+        for ii in changed:
+            category, moduleIndex = self.categories[ii]
+            work.setdefault(category, set()).add(moduleIndex)
+        for moduleIndex in work.get(GAIN, set()):
+            if moduleIndex in waves:
+                # Already resynthesized with the new amplitudes, for a
+                # waveform or queue change at this same point
+                continue
+            module = self.config.modules[moduleIndex]
+            gains, normalized = QuadLO.hardwareGains(module.pulseDescriptors, module.queues)
+            if normalized == module.normalizedWaves:
+                # The waveforms on the AWG are at full scale exactly where the
+                # new amplitudes need them to be
+                QuadLO.applyGains(module)
+            else:
+                # The new amplitudes need different waveforms at full scale
+                # (or baked) from those on the AWG, e.g. returning to a
+                # uniform channel after a point that needed them baked, so
+                # fall back to new waveforms.
+                work.setdefault(WAVEFORM, set()).add(moduleIndex)
+                waves[moduleIndex] = self._synthesizeModule(moduleIndex, point, [])
+        log.info("Sweep point %s: updating %s", point, sorted(work))
+        for moduleIndex in work.get(REGISTER, []):
+            module = self.config.modules[moduleIndex]
+            QuadLO.setupLOs(module)
+            QuadLO.writeRegisters(module)
+        for moduleIndex in work.get(WAVEFORM, set()) | work.get(QUEUE, set()):
+            module = self.config.modules[moduleIndex]
+            QuadLO.stopAwg(module)
+            for channel in range(1, module.channels + 1):
+                sd1.check(module.handle.AWGflush(channel), 'AWGflush', module.slot, channel)
+            if moduleIndex in waves:
+                sd1.check(module.handle.waveformFlush(), 'waveformFlush', module.slot)
+                QuadLO.uploadWaves(module, *waves[moduleIndex])
+            QuadLO.enqueueWaves(module)
+        if HVI_CONSTANT in work:
+            QuadLO.writeHviConstants()
+            QuadLO.compileDownloadHvi()
+
+    def _acquire(self, point):
+        index = 0
+        for daqData in QuadLO.acquireAll():
+            for channelData in daqData:
+                if isinstance(channelData, CaptureStatistics):
+                    channelData = [channelData.mean]
+                self.results[point + (index,)] = np.array(channelData)
+                index += 1
+        sd1.check(self.config.hvi.handle.stop(), 'HVI stop')
+        for module in self.digitizers:
+            QuadLO.rearmDaqs(module)
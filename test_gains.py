@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the channel amplitude planning in gains.hardwareGains, which must
+never leave a channel applying its amplitude through channelAmplitude while
+any of its waveforms still has the amplitude baked in.
+
+@author: gumcbrid
+"""
+
+import unittest
+
+from Configuration import PulseDescriptor, SubPulseDescriptor, Queue, QueueItem
+from gains import hardwareGains, waveAliases
+
+
+def pulse(waveId, amplitude, pri=1E-6):
+    return PulseDescriptor(waveId, pri, [SubPulseDescriptor(0, 100E-9, 0, amplitude, 100E6)])
+
+
+def queue(channel, *waveIds):
+    return Queue(channel, True, [QueueItem(waveId, False, 0, 1) for waveId in waveIds])
+
+
+class HardwareGainsTest(unittest.TestCase):
+    def assertConsistent(self, pulseDescriptors, queues, gains, normalized):
+        # Every waveform a channel with a gain plays is loaded at full scale
+        aliases = waveAliases(pulseDescriptors)
+        for q in queues:
+            roots = set(aliases[item.pulse_id] for item in q.items)
+            if q.channel in gains:
+                self.assertTrue(roots <= normalized, q.channel)
+            else:
+                self.assertFalse(roots & normalized, q.channel)
+
+    def test_separate_channels(self):
+        pulseDescriptors = [pulse(1, 0.5), pulse(2, 0.3)]
+        queues = [queue(1, 1), queue(2, 2)]
+        gains, normalized = hardwareGains(pulseDescriptors, queues)
+        self.assertEqual(gains, {1: 0.5, 2: 0.3})
+        self.assertEqual(normalized, {1, 2})
+
+    def test_waveform_shared_with_baked_channel(self):
+        # Channel 2 mixes amplitudes, so waveform 1 is baked for it, and
+        # channel 1 must not apply 0.5 on top of that.
+        pulseDescriptors = [pulse(1, 0.5), pulse(2, 0.3)]
+        queues = [queue(1, 1), queue(2, 1, 2)]
+        gains, normalized = hardwareGains(pulseDescriptors, queues)
+        self.assertEqual(gains, {})
+        self.assertEqual(normalized, set())
+        self.assertConsistent(pulseDescriptors, queues, gains, normalized)
+
+    def test_baked_channels_cascade(self):
+        # Waveform 3 is only baked because channel 1 shares waveform 1 with
+        # channel 2, and that has to reach channel 3 as well.
+        pulseDescriptors = [pulse(1, 0.5), pulse(2, 0.3), pulse(3, 0.5, pri=2E-6)]
+        queues = [queue(3, 3), queue(1, 1, 3), queue(2, 1, 2)]
+        gains, normalized = hardwareGains(pulseDescriptors, queues)
+        self.assertEqual(gains, {})
+        self.assertEqual(normalized, set())
+        self.assertConsistent(pulseDescriptors, queues, gains, normalized)
+
+    def test_normalized_uses_alias_roots(self):
+        # Waveform 2 duplicates waveform 1, so it is waveform 1 that is
+        # synthesized, and so has to be the one normalized.
+        pulseDescriptors = [pulse(1, 0.5), pulse(2, 0.5)]
+        queues = [queue(1, 2)]
+        gains, normalized = hardwareGains(pulseDescriptors, queues)
+        self.assertEqual(gains, {1: 0.5})
+        self.assertEqual(normalized, {1})
+        self.assertConsistent(pulseDescriptors, queues, gains, normalized)
+
+
+if (__name__ == '__main__'):
+    unittest.main()